@@ -3,33 +3,63 @@ Configuration module for Video Downloader Bot
 """
 
 import os
+import shutil
 import logging
+import subprocess
+from functools import lru_cache
 
 logger = logging.getLogger(__name__)
 
+@lru_cache(maxsize=None)
+def _probe_binary(name: str) -> bool:
+    """Check once per process whether an executable is available and runs."""
+    if shutil.which(name) is None:
+        return False
+    
+    try:
+        subprocess.run([name, '-version'],
+                       stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL,
+                       check=True)
+        return True
+    except (subprocess.CalledProcessError, OSError):
+        return False
+
 class Config:
     """Configuration class for bot settings."""
     
+    _instance = None
+    
+    # Environment variables checked for the bot token, in order of preference
+    TOKEN_ENV_KEYS = ('BOT_TOKEN', 'TELEGRAM_BOT_TOKEN', 'TELE_TOKEN')
+    
+    def __new__(cls):
+        # Environment values are static for the process, so reuse one instance
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+        return cls._instance
+    
     def __init__(self):
+        if getattr(self, '_initialized', False):
+            return
+        
         self.BOT_TOKEN = self._get_bot_token()
         self.MAX_FILE_SIZE = 50 * 1024 * 1024  # 50MB - Telegram limit
         self.TEMP_DIR = os.path.join(os.getcwd(), 'temp')
         self.LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
         
+        # Webhook mode is used when a public URL is configured, polling otherwise
+        self.WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+        self.PORT = self._get_port() if self.WEBHOOK_URL else None
+        
         # Create temp directory if it doesn't exist
-        if not os.path.exists(self.TEMP_DIR):
-            os.makedirs(self.TEMP_DIR)
+        os.makedirs(self.TEMP_DIR, exist_ok=True)
+        
+        self._initialized = True
     
     def _get_bot_token(self) -> str:
         """Get bot token from environment variables."""
-        token = os.getenv('BOT_TOKEN')
-        
-        if not token:
-            # Try alternative environment variable names
-            token = os.getenv('TELEGRAM_BOT_TOKEN')
-            
-        if not token:
-            token = os.getenv('TELE_TOKEN')
+        token = next((v for k in self.TOKEN_ENV_KEYS if (v := os.environ.get(k))), None)
             
         if not token:
             logger.error("Bot token not found in environment variables!")
@@ -38,6 +68,15 @@ class Config:
         
         return token
     
+    def _get_port(self) -> int:
+        """Get the webhook listen port from the environment."""
+        port = os.getenv('PORT', '8443')
+        try:
+            return int(port)
+        except ValueError:
+            logger.error(f"Invalid PORT value: {port}")
+            raise ValueError("PORT must be an integer when WEBHOOK_URL is set") from None
+    
     def validate_config(self) -> bool:
         """Validate configuration settings."""
         try:
@@ -50,27 +89,16 @@ class Config:
                 return False
                 
             # Check if ffmpeg is available
-            import subprocess
-            try:
-                subprocess.run(['ffmpeg', '-version'], 
-                             stdout=subprocess.PIPE, 
-                             stderr=subprocess.PIPE, 
-                             check=True)
-                logger.info("FFmpeg is available")
-            except (subprocess.CalledProcessError, FileNotFoundError):
+            if not _probe_binary('ffmpeg'):
                 logger.error("FFmpeg is not available. Please install ffmpeg.")
                 return False
+            logger.info("FFmpeg is available")
             
             # Check if ffprobe is available
-            try:
-                subprocess.run(['ffprobe', '-version'], 
-                             stdout=subprocess.PIPE, 
-                             stderr=subprocess.PIPE, 
-                             check=True)
-                logger.info("FFprobe is available")
-            except (subprocess.CalledProcessError, FileNotFoundError):
+            if not _probe_binary('ffprobe'):
                 logger.error("FFprobe is not available. Please install ffmpeg with ffprobe.")
                 return False
+            logger.info("FFprobe is available")
             
             logger.info("Configuration validation successful")
             return True
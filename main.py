@@ -5,16 +5,15 @@ Downloads videos from various platforms and sends them to users
 """
 
 import os
+import heapq
 import logging
 import asyncio
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, MessageEntity, InputFile
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
 from telegram.constants import ParseMode
 from video_downloader import VideoDownloader
 from config import Config
-from utils import format_file_size, is_valid_url, cleanup_temp_files
-import tempfile
-import shutil
+from utils import format_file_size, is_valid_url, match_platform_url, cleanup_temp_files, cleanup_stale_temp_files, create_temp_dir, StatusThrottler
 
 # Configure logging
 logging.basicConfig(
@@ -23,15 +22,24 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-class VideoDownloaderBot:
-    def __init__(self):
-        self.config = Config()
-        self.downloader = VideoDownloader()
-        self.temp_dir = tempfile.mkdtemp()
-        
-    async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Send a message when the command /start is issued."""
-        welcome_text = """
+def _prerender_markdown(text: str) -> tuple[str, list[MessageEntity]]:
+    """Strip *bold* markers from a static text and build the matching entities."""
+    parts = []
+    entities = []
+    offset = 0
+    
+    for i, part in enumerate(text.strip().split('*')):
+        # Telegram entity offsets are counted in UTF-16 code units
+        length = len(part.encode('utf-16-le')) // 2
+        if i % 2 and part:
+            entities.append(MessageEntity(MessageEntity.BOLD, offset, length))
+        parts.append(part)
+        offset += length
+    
+    return ''.join(parts), entities
+
+# Static replies are rendered once and sent with entities, so Telegram doesn't re-parse Markdown
+WELCOME_TEXT, WELCOME_ENTITIES = _prerender_markdown("""
 🎥 *Video Downloader Bot*
 
 Welcome! I can download videos from various platforms including:
@@ -54,16 +62,9 @@ Welcome! I can download videos from various platforms including:
 /about - About this bot
 
 Just send me any video URL to get started! 🚀
-        """
-        
-        await update.message.reply_text(
-            welcome_text,
-            parse_mode=ParseMode.MARKDOWN
-        )
+""")
 
-    async def help_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Send help information."""
-        help_text = """
+HELP_TEXT, HELP_ENTITIES = _prerender_markdown("""
 🆘 *Help - Video Downloader Bot*
 
 *Supported Platforms:*
@@ -92,16 +93,9 @@ Just send me any video URL to get started! 🚀
 • Some platforms may have restrictions
 
 Need more help? Contact the developer!
-        """
-        
-        await update.message.reply_text(
-            help_text,
-            parse_mode=ParseMode.MARKDOWN
-        )
+""")
 
-    async def about(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Send about information."""
-        about_text = """
+ABOUT_TEXT, ABOUT_ENTITIES = _prerender_markdown("""
 ℹ️ *About Video Downloader Bot*
 
 This bot helps you download videos from various social media platforms and video hosting sites.
@@ -123,18 +117,48 @@ This bot helps you download videos from various social media platforms and video
 
 ⚠️ *Disclaimer:*
 Please respect copyright laws and platform terms of service when downloading videos.
-        """
+""")
+
+# Callback data for quality buttons: format id and the original message id.
+# Pipe-separated because yt-dlp format ids can contain underscores.
+DOWNLOAD_CALLBACK = "download|%s|%d"
+
+class VideoDownloaderBot:
+    def __init__(self):
+        self.config = Config()
+        self.downloader = VideoDownloader()
         
+        # Remove leftovers from runs that exited without cleaning up
+        cleanup_stale_temp_files()
+        self.temp_dir = create_temp_dir()
+        
+    async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Send a message when the command /start is issued."""
         await update.message.reply_text(
-            about_text,
-            parse_mode=ParseMode.MARKDOWN
+            WELCOME_TEXT,
+            entities=WELCOME_ENTITIES
+        )
+
+    async def help_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Send help information."""
+        await update.message.reply_text(
+            HELP_TEXT,
+            entities=HELP_ENTITIES
+        )
+
+    async def about(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Send about information."""
+        await update.message.reply_text(
+            ABOUT_TEXT,
+            entities=ABOUT_ENTITIES
         )
 
     async def handle_url(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle video URL messages."""
         url = update.message.text.strip()
         
-        if not is_valid_url(url):
+        # Known platforms match a precompiled regex; anything else gets the generic check
+        if not match_platform_url(url) and not is_valid_url(url):
             await update.message.reply_text(
                 "❌ Please send a valid video URL.\n\n"
                 "Example: https://www.youtube.com/watch?v=..."
@@ -143,9 +167,8 @@ Please respect copyright laws and platform terms of service when downloading vid
 
         # Send initial processing message
         status_message = await update.message.reply_text(
-            "🔍 *Processing your request...*\n"
-            "Extracting video information...",
-            parse_mode=ParseMode.MARKDOWN
+            "🔍 Processing your request...\n"
+            "Extracting video information..."
         )
 
         try:
@@ -179,19 +202,23 @@ Please respect copyright laws and platform terms of service when downloading vid
                 )
                 return
             
-            # Sort formats by quality (height)
-            video_formats.sort(key=lambda x: x.get('height', 0), reverse=True)
-            
-            # Check if we have multiple good quality options
-            good_formats = [f for f in video_formats if f.get('height', 0) >= 360]
+            # Look up each format's height once, then pick the top 5 good
+            # quality formats (360p+) by index
+            heights = [f.get('height') or 0 for f in video_formats]
+            good_indices = heapq.nlargest(
+                5,
+                (i for i, h in enumerate(heights) if h >= 360),
+                key=heights.__getitem__
+            )
             
-            if len(good_formats) > 1:
+            if len(good_indices) > 1:
                 # Show quality selection for high quality formats
                 keyboard = []
                 
-                # Add quality options (limit to top 5)
-                for i, fmt in enumerate(good_formats[:5]):
-                    height = fmt.get('height', 'Unknown')
+                # Add quality options
+                for i in good_indices:
+                    fmt = video_formats[i]
+                    height = heights[i]
                     ext = fmt.get('ext', 'mp4')
                     filesize = fmt.get('filesize')
                     
@@ -203,13 +230,13 @@ Please respect copyright laws and platform terms of service when downloading vid
                     
                     keyboard.append([InlineKeyboardButton(
                         quality_text,
-                        callback_data=f"download_{fmt['format_id']}_{update.message.message_id}"
+                        callback_data=DOWNLOAD_CALLBACK % (fmt['format_id'], update.message.message_id)
                     )])
                 
                 # Add best quality option
                 keyboard.append([InlineKeyboardButton(
                     "🏆 Best Quality Available",
-                    callback_data=f"download_best_{update.message.message_id}"
+                    callback_data=DOWNLOAD_CALLBACK % ('best', update.message.message_id)
                 )])
 
                 reply_markup = InlineKeyboardMarkup(keyboard)
@@ -230,13 +257,14 @@ Please respect copyright laws and platform terms of service when downloading vid
                     reply_markup=reply_markup
                 )
                 
-                # Store URL for callback
+                # Store URL for callback; the extracted info stays in the
+                # downloader's bounded cache instead of per-user state
                 context.user_data[f"url_{update.message.message_id}"] = url
                 
             else:
                 # Download directly with best available quality
                 await self.download_and_send_video(
-                    update, context, status_message, url, "best"
+                    update, context, status_message, url, "best", video_info
                 )
 
         except Exception as e:
@@ -254,42 +282,48 @@ Please respect copyright laws and platform terms of service when downloading vid
         await query.answer()
 
         callback_data = query.data
-        parts = callback_data.split('_')
+        parts = callback_data.split('|', 2)
         
-        if len(parts) < 3:
+        if len(parts) < 3 or parts[0] != 'download':
             await query.edit_message_text("❌ Invalid selection. Please try again.")
             return
             
-        format_id = parts[1]
-        message_id = parts[2]
+        _, format_id, message_id = parts
         
-        # Get stored URL
-        url = context.user_data.get(f"url_{message_id}")
+        # Get stored URL, dropping it so user_data does not grow per request
+        url = context.user_data.pop(f"url_{message_id}", None)
         if not url:
             await query.edit_message_text("❌ Session expired. Please send the URL again.")
             return
 
+        # Reuse the extracted info while the downloader still caches it, so
+        # compression can skip ffprobe
         await self.download_and_send_video(
-            update, context, query.message, url, format_id
+            update, context, query.message, url, format_id,
+            self.downloader.get_cached_info(url)
         )
 
-    async def download_and_send_video(self, update, context, status_message, url, format_id):
+    async def download_and_send_video(self, update, context, status_message, url, format_id, video_info=None):
         """Download and send video to user."""
+        loop = asyncio.get_running_loop()
+        status = StatusThrottler(status_message)
+        download_path = None
+        
         try:
             # Update status
-            await status_message.edit_text(
-                "⬇️ *Downloading video...*\n"
-                "This may take a few moments depending on video size.",
-                parse_mode=ParseMode.MARKDOWN
+            status.set(
+                "⬇️ Downloading video...\n"
+                "This may take a few moments depending on video size."
             )
 
             # Download video
             download_path = await self.downloader.download_video(
-                url, self.temp_dir, format_id
+                url, self.temp_dir, format_id, video_info
             )
             
-            if not download_path or not os.path.exists(download_path):
-                await status_message.edit_text(
+            # Filesystem calls run in the executor to keep the event loop free
+            if not download_path or not await loop.run_in_executor(None, os.path.exists, download_path):
+                await status.finish(
                     "❌ *Download Failed*\n"
                     "Could not download the video. Please try again.",
                     parse_mode=ParseMode.MARKDOWN
@@ -297,25 +331,40 @@ Please respect copyright laws and platform terms of service when downloading vid
                 return
 
             # Check file size
-            file_size = os.path.getsize(download_path)
+            file_size = await loop.run_in_executor(None, os.path.getsize, download_path)
             max_size = 50 * 1024 * 1024  # 50MB Telegram limit
 
             if file_size > max_size:
-                await status_message.edit_text(
-                    "🔄 *Compressing video...*\n"
-                    "File is too large, compressing to fit Telegram limits.",
-                    parse_mode=ParseMode.MARKDOWN
+                status.set(
+                    "🔄 Compressing video...\n"
+                    "File is too large, compressing to fit Telegram limits."
                 )
                 
+                # Reuse duration/height from the extracted info to skip ffprobe
+                duration = height = None
+                if video_info:
+                    duration = video_info.get('duration')
+                    height = next(
+                        (f.get('height') for f in video_info.get('formats', [])
+                         if f.get('format_id') == format_id),
+                        video_info.get('height')
+                    )
+                
                 # Compress video
                 compressed_path = await self.downloader.compress_video(
-                    download_path, max_size
+                    download_path, max_size, duration, height
                 )
                 
-                if compressed_path and os.path.exists(compressed_path):
+                # compress_video only returns a path once the output exists and fits
+                if compressed_path:
+                    # Keep a single copy on disk: the original is no longer needed
+                    try:
+                        await loop.run_in_executor(None, os.remove, download_path)
+                    except OSError:
+                        pass
                     download_path = compressed_path
                 else:
-                    await status_message.edit_text(
+                    await status.finish(
                         "❌ *Compression Failed*\n"
                         "Video is too large and compression failed.",
                         parse_mode=ParseMode.MARKDOWN
@@ -323,18 +372,22 @@ Please respect copyright laws and platform terms of service when downloading vid
                     return
 
             # Update status for upload
-            await status_message.edit_text(
-                "⬆️ *Uploading video...*\n"
-                "Almost done!",
-                parse_mode=ParseMode.MARKDOWN
+            status.set(
+                "⬆️ Uploading video...\n"
+                "Almost done!"
             )
 
             # Send video
+            # Hand over the open file unread so the upload is streamed from disk
             chat_id = update.effective_chat.id
             with open(download_path, 'rb') as video_file:
                 await context.bot.send_video(
                     chat_id=chat_id,
-                    video=video_file,
+                    video=InputFile(
+                        video_file,
+                        filename=os.path.basename(download_path),
+                        read_file_handle=False
+                    ),
                     supports_streaming=True,
                     caption="✅ *Video downloaded successfully!*\n\n"
                            "Powered by Video Downloader Bot 🤖",
@@ -342,23 +395,27 @@ Please respect copyright laws and platform terms of service when downloading vid
                 )
 
             # Delete status message
+            await status.close()
             await status_message.delete()
 
-            # Clean up temporary files
-            try:
-                os.remove(download_path)
-            except:
-                pass
-
         except Exception as e:
             logger.error(f"Error downloading video: {str(e)}")
-            await status_message.edit_text(
+            await status.finish(
                 f"❌ *Download Failed*\n"
                 f"Error: {str(e)}\n\n"
                 f"Please try again or contact support.",
                 parse_mode=ParseMode.MARKDOWN
             )
 
+        finally:
+            # Clean up temporary files, also when sending failed; compressed
+            # outputs may live in /dev/shm outside the tracked temp dir
+            if download_path:
+                try:
+                    await loop.run_in_executor(None, os.remove, download_path)
+                except OSError:
+                    pass
+
     async def error_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle errors."""
         logger.error(f"Update {update} caused error {context.error}")
@@ -385,8 +442,29 @@ Please respect copyright laws and platform terms of service when downloading vid
 
         logger.info("Starting Video Downloader Bot...")
         
+        # Use uvloop's faster event loop when it is installed
+        try:
+            import uvloop
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+            logger.info("Using uvloop event loop")
+        except ImportError:
+            pass
+        
+        # Only request the update types the bot has handlers for
+        allowed_updates = [Update.MESSAGE, Update.CALLBACK_QUERY]
+        
         # Start the bot
-        application.run_polling(allowed_updates=Update.ALL_TYPES)
+        if self.config.WEBHOOK_URL:
+            logger.info(f"Using webhook mode on port {self.config.PORT}")
+            application.run_webhook(
+                listen='0.0.0.0',
+                port=self.config.PORT,
+                url_path=self.config.BOT_TOKEN,
+                webhook_url=f"{self.config.WEBHOOK_URL.rstrip('/')}/{self.config.BOT_TOKEN}",
+                allowed_updates=allowed_updates
+            )
+        else:
+            application.run_polling(allowed_updates=allowed_updates)
 
 def main():
     """Main function."""
@@ -4,72 +4,89 @@ Utility functions for Video Downloader Bot
 
 import os
 import re
+import time
+import atexit
+import asyncio
 import shutil
 import tempfile
 import logging
+from pathlib import PurePath
 from urllib.parse import urlparse
 from typing import Optional
 
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
 logger = logging.getLogger(__name__)
 
+_SIZE_NAMES = ("B", "KB", "MB", "GB", "TB")
+
 def format_file_size(size_bytes: int) -> str:
     """Format file size in human readable format."""
     if size_bytes == 0:
         return "0 B"
     
-    size_names = ["B", "KB", "MB", "GB", "TB"]
-    i = 0
-    while size_bytes >= 1024.0 and i < len(size_names) - 1:
-        size_bytes /= 1024.0
-        i += 1
+    # Each unit step is 2**10, so the unit index follows from the bit length
+    i = max(0, min((int(size_bytes).bit_length() - 1) // 10, len(_SIZE_NAMES) - 1))
     
-    return f"{size_bytes:.1f} {size_names[i]}"
+    return f"{size_bytes / (1 << (10 * i)):.1f} {_SIZE_NAMES[i]}"
 
 def is_valid_url(url: str) -> bool:
     """Check if the provided string is a valid URL."""
     try:
         result = urlparse(url)
-        return all([result.scheme, result.netloc])
-    except Exception:
+    except ValueError:
+        # Malformed netloc, e.g. an unclosed IPv6 bracket
         return False
+    
+    return bool(result.scheme) and bool(result.netloc)
+
+# Video ID patterns per platform, compiled once at import time
+_VIDEO_ID_PATTERNS = {
+    'youtube': [
+        r'(?:youtube\.com\/watch\?v=|youtu\.be\/|youtube\.com\/embed\/)([^&\n?#]+)',
+        r'youtube\.com\/watch\?.*v=([^&\n?#]+)'
+    ],
+    'instagram': [
+        r'instagram\.com\/p\/([^\/\?]+)',
+        r'instagram\.com\/reel\/([^\/\?]+)',
+        r'instagram\.com\/tv\/([^\/\?]+)'
+    ],
+    'tiktok': [
+        r'tiktok\.com\/.*\/video\/(\d+)',
+        r'vm\.tiktok\.com\/([^\/\?]+)',
+        r'tiktok\.com\/@[^\/]+\/video\/(\d+)'
+    ],
+    'twitter': [
+        r'twitter\.com\/\w+\/status\/(\d+)',
+        r'x\.com\/\w+\/status\/(\d+)'
+    ]
+}
+
+_COMPILED_PATTERNS = {
+    platform: [re.compile(p, re.IGNORECASE) for p in platform_patterns]
+    for platform, platform_patterns in _VIDEO_ID_PATTERNS.items()
+}
 
 def extract_video_id(url: str) -> Optional[str]:
     """Extract video ID from various platform URLs."""
-    patterns = {
-        'youtube': [
-            r'(?:youtube\.com\/watch\?v=|youtu\.be\/|youtube\.com\/embed\/)([^&\n?#]+)',
-            r'youtube\.com\/watch\?.*v=([^&\n?#]+)'
-        ],
-        'instagram': [
-            r'instagram\.com\/p\/([^\/\?]+)',
-            r'instagram\.com\/reel\/([^\/\?]+)',
-            r'instagram\.com\/tv\/([^\/\?]+)'
-        ],
-        'tiktok': [
-            r'tiktok\.com\/.*\/video\/(\d+)',
-            r'vm\.tiktok\.com\/([^\/\?]+)',
-            r'tiktok\.com\/@[^\/]+\/video\/(\d+)'
-        ],
-        'twitter': [
-            r'twitter\.com\/\w+\/status\/(\d+)',
-            r'x\.com\/\w+\/status\/(\d+)'
-        ]
-    }
-    
-    for platform, platform_patterns in patterns.items():
+    for platform_patterns in _COMPILED_PATTERNS.values():
         for pattern in platform_patterns:
-            match = re.search(pattern, url, re.IGNORECASE)
+            match = pattern.search(url)
             if match:
                 return match.group(1)
     
     return None
 
+# Invalid characters for most file systems, replaced with underscores
+_FILENAME_TABLE = str.maketrans({c: '_' for c in '<>:"/\\|?*'})
+
 def sanitize_filename(filename: str) -> str:
     """Sanitize filename by removing invalid characters."""
     # Remove invalid characters for most file systems
-    invalid_chars = '<>:"/\\|?*'
-    for char in invalid_chars:
-        filename = filename.replace(char, '_')
+    filename = filename.translate(_FILENAME_TABLE)
     
     # Remove leading/trailing spaces and dots
     filename = filename.strip('. ')
@@ -82,97 +99,217 @@ def sanitize_filename(filename: str) -> str:
     
     return filename
 
+# Known domains per platform, matched against the end of the URL's netloc
+_PLATFORM_DOMAINS = {
+    'youtube': ['youtube.com', 'youtu.be', 'm.youtube.com'],
+    'instagram': ['instagram.com', 'www.instagram.com'],
+    'tiktok': ['tiktok.com', 'www.tiktok.com', 'vm.tiktok.com'],
+    'twitter': ['twitter.com', 'x.com', 'mobile.twitter.com'],
+    'facebook': ['facebook.com', 'www.facebook.com', 'm.facebook.com', 'fb.watch'],
+    'reddit': ['reddit.com', 'www.reddit.com', 'v.redd.it'],
+    'twitch': ['twitch.tv', 'www.twitch.tv', 'clips.twitch.tv'],
+    'vimeo': ['vimeo.com', 'www.vimeo.com']
+}
+
+_DOMAIN_TO_PLATFORM = {
+    domain: platform
+    for platform, domains in _PLATFORM_DOMAINS.items()
+    for domain in domains
+}
+
+# Single alternation over every known domain, longest first
+_DOMAIN_RE = re.compile(
+    r'(?:^|\.)(' +
+    '|'.join(re.escape(d) for d in sorted(_DOMAIN_TO_PLATFORM, key=len, reverse=True)) +
+    r')$'
+)
+
+# Full-URL matcher for the known platforms, used to skip urlparse on the common case
+_ACCEPTED_URL_RE = re.compile(
+    r'^https?://(?:[\w-]+\.)*?(' +
+    '|'.join(re.escape(d) for d in sorted(_DOMAIN_TO_PLATFORM, key=len, reverse=True)) +
+    r')(?::\d+)?(?:[/?#]|$)',
+    re.IGNORECASE
+)
+
+def match_platform_url(url: str) -> Optional[str]:
+    """Return the platform for a URL on a known platform, or None."""
+    match = _ACCEPTED_URL_RE.match(url)
+    return _DOMAIN_TO_PLATFORM[match.group(1).lower()] if match else None
+
 def get_video_platform(url: str) -> Optional[str]:
     """Identify video platform from URL."""
-    domain_patterns = {
-        'youtube': ['youtube.com', 'youtu.be', 'm.youtube.com'],
-        'instagram': ['instagram.com', 'www.instagram.com'],
-        'tiktok': ['tiktok.com', 'www.tiktok.com', 'vm.tiktok.com'],
-        'twitter': ['twitter.com', 'x.com', 'mobile.twitter.com'],
-        'facebook': ['facebook.com', 'www.facebook.com', 'm.facebook.com', 'fb.watch'],
-        'reddit': ['reddit.com', 'www.reddit.com', 'v.redd.it'],
-        'twitch': ['twitch.tv', 'www.twitch.tv', 'clips.twitch.tv'],
-        'vimeo': ['vimeo.com', 'www.vimeo.com']
-    }
-    
     try:
         domain = urlparse(url).netloc.lower()
         
-        for platform, domains in domain_patterns.items():
-            if any(domain.endswith(d) for d in domains):
-                return platform
-        
-        return 'unknown'
+        match = _DOMAIN_RE.search(domain)
+        return _DOMAIN_TO_PLATFORM[match.group(1)] if match else 'unknown'
         
     except Exception:
         return None
 
+# Prefix for temp directories created by this bot
+TEMP_PREFIX = "video_downloader_bot_"
+
+# Leftover temp items younger than this (seconds) may belong to another
+# running instance and are never swept
+STALE_TEMP_AGE = 60 * 60
+
+# Lock file held open by the instance that owns a temp directory
+_LOCK_FILE_NAME = '.lock'
+
+# Temp directories created by this process, removed on cleanup
+_TRACKED_TEMP_DIRS: set[str] = set()
+
+# Open lock file descriptors for the tracked temp directories
+_TEMP_DIR_LOCKS: dict[str, int] = {}
+
+def create_temp_dir() -> str:
+    """Create a temp directory that is removed by cleanup_temp_files."""
+    path = tempfile.mkdtemp(prefix=TEMP_PREFIX)
+    _TRACKED_TEMP_DIRS.add(path)
+    
+    # Hold a lock for the lifetime of the process so other instances'
+    # startup sweeps can tell the directory is still in use
+    if fcntl is not None:
+        fd = None
+        try:
+            fd = os.open(os.path.join(path, _LOCK_FILE_NAME), os.O_CREAT | os.O_RDWR)
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            _TEMP_DIR_LOCKS[path] = fd
+        except OSError as e:
+            # e.g. ENOLCK on NFS; without the lock only the age check protects the dir
+            logger.warning(f"Could not lock temp directory {path}: {str(e)}")
+            if fd is not None:
+                os.close(fd)
+    
+    return path
+
+def _release_temp_dir_lock(path: str):
+    """Close the lock file held for a temp directory, if any."""
+    fd = _TEMP_DIR_LOCKS.pop(path, None)
+    if fd is not None:
+        os.close(fd)
+
+def _is_temp_dir_locked(path: str) -> bool:
+    """Check whether another process holds the lock of a temp directory."""
+    if fcntl is None:
+        return False
+    
+    try:
+        fd = os.open(os.path.join(path, _LOCK_FILE_NAME), os.O_RDWR)
+    except OSError:
+        return False
+    
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return False
+    except OSError:
+        return True
+    finally:
+        os.close(fd)
+
 def cleanup_temp_files(temp_dir: Optional[str] = None):
     """Clean up temporary files and directories."""
     try:
+        if temp_dir:
+            _release_temp_dir_lock(temp_dir)
+            _TRACKED_TEMP_DIRS.discard(temp_dir)
+        
         if temp_dir and os.path.exists(temp_dir):
             shutil.rmtree(temp_dir)
             logger.info(f"Cleaned up temp directory: {temp_dir}")
         
-        # Also clean up system temp files related to this bot
-        temp_prefix = "video_downloader_bot_"
-        temp_root = tempfile.gettempdir()
-        
-        for item in os.listdir(temp_root):
-            if item.startswith(temp_prefix):
-                item_path = os.path.join(temp_root, item)
+        # Also clean up the other temp directories created by this process
+        while _TRACKED_TEMP_DIRS:
+            path = _TRACKED_TEMP_DIRS.pop()
+            _release_temp_dir_lock(path)
+            shutil.rmtree(path, ignore_errors=True)
+                    
+    except Exception as e:
+        logger.error(f"Error during cleanup: {str(e)}")
+
+atexit.register(cleanup_temp_files)
+
+def cleanup_stale_temp_files(temp_root: Optional[str] = None):
+    """Remove temp items left in temp_root (default: the system temp dir) by previous runs."""
+    cutoff = time.time() - STALE_TEMP_AGE
+    try:
+        with os.scandir(temp_root or tempfile.gettempdir()) as entries:
+            for entry in entries:
+                if not entry.name.startswith(TEMP_PREFIX) or entry.path in _TRACKED_TEMP_DIRS:
+                    continue
                 try:
-                    if os.path.isfile(item_path):
-                        os.remove(item_path)
-                    elif os.path.isdir(item_path):
-                        shutil.rmtree(item_path)
+                    # Recent items may be live work of another instance
+                    if entry.stat(follow_symlinks=False).st_mtime > cutoff:
+                        continue
+                    
+                    # DirEntry answers is_dir() from the directory listing, no extra stat
+                    if entry.is_dir(follow_symlinks=False):
+                        if _is_temp_dir_locked(entry.path):
+                            continue
+                        shutil.rmtree(entry.path)
+                    else:
+                        os.remove(entry.path)
                 except Exception as e:
-                    logger.warning(f"Could not remove temp item {item_path}: {str(e)}")
+                    logger.warning(f"Could not remove temp item {entry.path}: {str(e)}")
                     
     except Exception as e:
-        logger.error(f"Error during cleanup: {str(e)}")
+        logger.error(f"Error during stale temp cleanup: {str(e)}")
+
+_VIDEO_EXTENSIONS = frozenset(['.mp4', '.avi', '.mkv', '.mov', '.wmv', '.flv', '.webm', '.m4v'])
 
 def validate_video_file(file_path: str) -> bool:
     """Validate if file is a proper video file."""
-    if not os.path.exists(file_path):
+    try:
+        st = os.stat(file_path)
+    except OSError:
         return False
     
     # Check file size (should be > 0)
-    if os.path.getsize(file_path) == 0:
+    if st.st_size == 0:
         return False
     
     # Check file extension
-    video_extensions = ['.mp4', '.avi', '.mkv', '.mov', '.wmv', '.flv', '.webm', '.m4v']
     file_ext = os.path.splitext(file_path)[1].lower()
     
-    return file_ext in video_extensions
+    return file_ext in _VIDEO_EXTENSIONS
 
 def get_file_info(file_path: str) -> dict:
     """Get basic file information."""
-    if not os.path.exists(file_path):
+    try:
+        stat = os.stat(file_path)
+    except OSError:
         return {}
     
-    stat = os.stat(file_path)
+    path = PurePath(file_path)
     
     return {
         'size': stat.st_size,
         'size_formatted': format_file_size(stat.st_size),
         'modified': stat.st_mtime,
-        'name': os.path.basename(file_path),
-        'extension': os.path.splitext(file_path)[1],
+        'name': path.name,
+        'extension': path.suffix,
         'directory': os.path.dirname(file_path)
     }
 
-def create_progress_bar(current: int, total: int, length: int = 20) -> str:
+# Pre-built bar segments; progress bars slice these instead of building new strings
+_BAR_LENGTH = 20
+_FULL_BAR = "█" * _BAR_LENGTH
+_EMPTY_BAR = "░" * _BAR_LENGTH
+
+def create_progress_bar(current: int, total: int, length: int = _BAR_LENGTH) -> str:
     """Create a text progress bar."""
+    full, empty = _FULL_BAR, _EMPTY_BAR
+    if length > _BAR_LENGTH:
+        full, empty = "█" * length, "░" * length
+    
     if total == 0:
-        return "█" * length
+        return full[:length]
     
-    filled_length = int(length * current // total)
-    bar = "█" * filled_length + "░" * (length - filled_length)
-    percent = round(100.0 * current / total, 1)
+    filled_length = min(length * current // total, length)
     
-    return f"{bar} {percent}%"
+    return f"{full[:filled_length]}{empty[:length - filled_length]} {100 * current // total}%"
 
 def truncate_text(text: str, max_length: int = 100) -> str:
     """Truncate text to specified length with ellipsis."""
@@ -181,14 +318,12 @@ def truncate_text(text: str, max_length: int = 100) -> str:
     
     return text[:max_length-3] + "..."
 
+_MARKDOWN_SPECIAL_CHARS = ['_', '*', '[', ']', '(', ')', '~', '`', '>', '#', '+', '-', '=', '|', '{', '}', '.', '!']
+_MARKDOWN_TABLE = str.maketrans({c: f'\\{c}' for c in _MARKDOWN_SPECIAL_CHARS})
+
 def escape_markdown(text: str) -> str:
     """Escape markdown special characters."""
-    special_chars = ['_', '*', '[', ']', '(', ')', '~', '`', '>', '#', '+', '-', '=', '|', '{', '}', '.', '!']
-    
-    for char in special_chars:
-        text = text.replace(char, f'\\{char}')
-    
-    return text
+    return text.translate(_MARKDOWN_TABLE)
 
 def validate_telegram_file_size(file_path: str) -> tuple[bool, str]:
     """Validate if file meets Telegram size requirements."""
@@ -205,3 +340,50 @@ def validate_telegram_file_size(file_path: str) -> tuple[bool, str]:
         return False, "File is empty"
     
     return True, "File size OK"
+
+
+class StatusThrottler:
+    """Debounce status message edits so only the latest text is sent."""
+    
+    def __init__(self, message, interval: float = 0.5):
+        self.message = message
+        self.interval = interval
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+        self._last_text: Optional[str] = None
+    
+    def set(self, text: str):
+        """Queue a plain-text status update; older pending updates are dropped."""
+        self._queue.put_nowait(text)
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+    
+    async def _run(self):
+        while True:
+            text = await self._queue.get()
+            while not self._queue.empty():
+                text = self._queue.get_nowait()
+            
+            if text != self._last_text:
+                try:
+                    await self.message.edit_text(text)
+                    self._last_text = text
+                except Exception as e:
+                    logger.warning(f"Could not update status message: {str(e)}")
+            
+            await asyncio.sleep(self.interval)
+    
+    async def close(self):
+        """Stop the background task and discard pending updates."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+    
+    async def finish(self, text: str, **kwargs):
+        """Stop throttling and send a final edit immediately."""
+        await self.close()
+        await self.message.edit_text(text, **kwargs)
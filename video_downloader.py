@@ -4,17 +4,211 @@ Handles video downloading and processing using yt-dlp and ffmpeg
 """
 
 import os
+import copy
+import json
 import asyncio
 import logging
+import multiprocessing
+import shutil
 import subprocess
 import tempfile
-from typing import Optional, Dict, Any
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from typing import Optional, Dict, Any, Hashable
 import yt_dlp
-from utils import format_file_size
+from utils import format_file_size, cleanup_stale_temp_files, TEMP_PREFIX
 
 logger = logging.getLogger(__name__)
 
+# Rate-distortion table: (min video bitrate budget in kbps, max output
+# height, crf). Smaller budgets encode fewer pixels at a higher CRF
+# instead of starving a full-resolution encode.
+_RD_TABLE = (
+    (4000, 1080, 23),
+    (2000, 720, 24),
+    (1000, 480, 25),
+    (500, 360, 26),
+    (0, 240, 28),
+)
+
+# Re-encode settings: (minimum crf, share of the size limit used as the
+# bitrate cap, audio bitrate in kbps). Later entries are tried when the
+# previous encode is still too large.
+_COMPRESSION_ATTEMPTS = [(0, 0.8, 128), (30, 0.7, 96), (34, 0.6, 64)]
+
+def _select_params(height: Optional[int], target_bitrate: int) -> tuple[Optional[int], int]:
+    """Pick the output height (None keeps the source size) and CRF for a bitrate budget."""
+    max_height, crf = next(
+        (h, c) for min_kbps, h, c in _RD_TABLE if target_bitrate >= min_kbps
+    )
+    if height and height > max_height:
+        return max_height, crf
+    return None, crf
+
+# Largest download accepted from any site
+_MAX_DOWNLOAD_BYTES = 500 * 1024 * 1024  # 500MB
+
+# ffmpeg invocation that only writes errors to stderr, without the banner
+# and per-frame progress lines
+_FFMPEG_CMD = ['ffmpeg', '-hide_banner', '-nostats', '-loglevel', 'error']
+
+# Amount of ffmpeg/ffprobe stderr kept for error logs
+_STDERR_TAIL_BYTES = 2000
+
+def _stderr_tail(stderr: bytes) -> str:
+    """Decode only the end of a process's stderr for logging."""
+    return stderr[-_STDERR_TAIL_BYTES:].decode('utf-8', errors='replace')
+
+# Suffixes of yt-dlp's in-progress files, never returned as a download
+_PARTIAL_SUFFIXES = ('.part', '.ytdl', '.temp')
+
+# Videos longer than this (seconds) are split and encoded in parallel segments
+_SEGMENT_MIN_DURATION = 60
+_SEGMENT_DURATION = 30
+
+# Round frame size down to even dimensions, required by yuv420p H.264
+_EVEN_DIMENSIONS_FILTER = 'scale=trunc(iw/2)*2:trunc(ih/2)*2'
+
+# Hardware H.264 encoders in order of preference; libx264 is the fallback
+_HW_H264_ENCODERS = ['h264_nvenc', 'h264_qsv', 'h264_videotoolbox']
+
+def _detect_h264_encoder() -> str:
+    """Return the first hardware H.264 encoder that works, else libx264."""
+    try:
+        process = subprocess.run(
+            ['ffmpeg', '-hide_banner', '-encoders'],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL
+        )
+        available = process.stdout.decode(errors='replace')
+        
+        for encoder in _HW_H264_ENCODERS:
+            if encoder not in available:
+                continue
+            
+            # Being compiled in doesn't mean the device exists, so try a tiny encode
+            test = subprocess.run(
+                ['ffmpeg', '-hide_banner', '-f', 'lavfi', '-i', 'color=s=256x256:d=0.1',
+                 '-c:v', encoder, '-f', 'null', '-'],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL
+            )
+            if test.returncode == 0:
+                return encoder
+                
+    except OSError as e:
+        logger.warning(f"Could not probe ffmpeg encoders: {str(e)}")
+    
+    return 'libx264'
+
+class _YoutubeDLPool:
+    """Reuse YoutubeDL instances per option set; each instance serves one thread at a time."""
+    
+    def __init__(self, max_keys: int = 16):
+        self.max_keys = max_keys
+        self._idle: OrderedDict[Hashable, list] = OrderedDict()
+        self._lock = threading.Lock()
+    
+    @contextmanager
+    def acquire(self, key: Hashable, opts: dict):
+        """Check out an idle instance for key, creating one from opts if needed."""
+        with self._lock:
+            idle = self._idle.get(key)
+            ydl = idle.pop() if idle else None
+        
+        if ydl is None:
+            ydl = yt_dlp.YoutubeDL(opts)
+        
+        try:
+            yield ydl
+        finally:
+            evicted = []
+            with self._lock:
+                self._idle.setdefault(key, []).append(ydl)
+                self._idle.move_to_end(key)
+                while len(self._idle) > self.max_keys:
+                    evicted.extend(self._idle.popitem(last=False)[1])
+            
+            for old in evicted:
+                old.close()
+
+# yt-dlp codec names that can be stream-copied into an mp4 Telegram plays
+_MP4_VIDEO_CODECS = ('avc1', 'h264')
+_MP4_AUDIO_CODECS = ('mp4a', 'aac', 'none')
+
+def _is_mp4_compatible(info: Dict[str, Any], format_id: str) -> bool:
+    """Check whether the formats behind format_id are H.264 with AAC or no audio."""
+    formats = {f.get('format_id'): f for f in info.get('formats', [])}
+    requested = [formats.get(fid) for fid in format_id.split('+')]
+    if not requested or None in requested:
+        return False
+    
+    vcodecs = [str(f.get('vcodec') or '') for f in requested]
+    acodecs = [str(f.get('acodec') or '') for f in requested]
+    return (
+        any(c.startswith(_MP4_VIDEO_CODECS) for c in vcodecs)
+        and all(c.startswith(_MP4_VIDEO_CODECS) or c == 'none' for c in vcodecs)
+        and all(c.startswith(_MP4_AUDIO_CODECS) for c in acodecs)
+    )
+
+def _is_format_downloadable(fmt: dict) -> bool:
+    """Check if a format is actually downloadable."""
+    # Checks are ordered by how often they reject: audio-only formats,
+    # missing URL, below 144p, empty files, then unavailable formats
+    return bool(
+        fmt.get('vcodec') != 'none'
+        and fmt.get('url')
+        and (fmt.get('height') or 144) >= 144
+        and fmt.get('filesize') != 0
+        and 'unavailable' not in str(fmt.get('format_note') or '').lower()
+    )
+
+# YoutubeDL instance reused by info extraction in each worker process
+_worker_ydl = None
+
+def _extract_info_worker(url: str, opts: dict) -> Optional[Dict[str, Any]]:
+    """Extract video info in a worker process; module-level so it can be pickled."""
+    global _worker_ydl
+    try:
+        if _worker_ydl is None:
+            _worker_ydl = yt_dlp.YoutubeDL(opts)
+        
+        info = _worker_ydl.extract_info(url, download=False)
+        if not info:
+            return info
+        
+        # Filter and validate formats
+        if 'formats' in info:
+            info['formats'] = [fmt for fmt in info['formats'] if _is_format_downloadable(fmt)]
+        
+        # Strip internal, unpicklable fields before sending back to the bot
+        return _worker_ydl.sanitize_info(info)
+    
+    except Exception as e:
+        # yt-dlp exceptions don't always survive pickling back to the parent
+        raise RuntimeError(str(e)) from None
+
+# Minimum free space on /dev/shm before it is used for compressed outputs
+_MIN_TMPFS_FREE = 1024 * 1024 * 1024  # 1GB
+
+def _select_tmp_base() -> str:
+    """Return /dev/shm if it is writable with enough free space, else the system temp dir."""
+    shm = '/dev/shm'
+    try:
+        if os.access(shm, os.W_OK) and shutil.disk_usage(shm).free >= _MIN_TMPFS_FREE:
+            return shm
+    except OSError:
+        pass
+    return tempfile.gettempdir()
+
 class VideoDownloader:
+    # Sorted extractor names, filled on the first get_supported_sites() call
+    _supported_sites_cache: Optional[tuple] = None
+    
     def __init__(self):
         self.ydl_opts_info = {
             'quiet': True,
@@ -27,66 +221,172 @@ class VideoDownloader:
             'writeautomaticsub': False,
             'ignoreerrors': False,
             'age_limit': None,
-            'max_filesize': 500 * 1024 * 1024,  # 500MB max
+            'max_filesize': _MAX_DOWNLOAD_BYTES,
         }
         
+        # Recently extracted info keyed by URL: url -> (expires_at, info)
+        self._info_cache: OrderedDict[str, tuple[float, Dict[str, Any]]] = OrderedDict()
+        self.info_cache_size = 512
+        self.info_cache_ttl = 300  # seconds
+        
+        # Limit concurrent encodes across all sessions and split the CPUs
+        # between them so parallel jobs don't oversubscribe the host
+        cpu_count = os.cpu_count() or 4
+        self.max_concurrent_ffmpeg = max(1, cpu_count // 2)
+        self._ffmpeg_sem = asyncio.Semaphore(self.max_concurrent_ffmpeg)
+        self._threads_per_job = max(1, cpu_count // self.max_concurrent_ffmpeg)
+        # One segmented video may hold at most half of the encode slots so
+        # other users' jobs are not queued behind all of its segments
+        self.max_segment_encodes = max(1, self.max_concurrent_ffmpeg // 2)
+        
+        # YoutubeDL instances are expensive to build, so reuse them across requests
+        self._ydl_pool = _YoutubeDLPool()
+        
+        # Worker processes for info extraction
+        self._proc_pool = self._create_proc_pool()
+        
+        # Dedicated threads for network-bound yt-dlp downloads, so a burst of
+        # requests doesn't queue behind other users of the default executor
+        self._net_pool = ThreadPoolExecutor(max_workers=16, thread_name_prefix='ytdl')
+        
+        # Compressed outputs go to tmpfs when there's room, keeping the
+        # intermediate writes in RAM instead of on a slow disk
+        self._tmp_base = _select_tmp_base()
+        if self._tmp_base != tempfile.gettempdir():
+            # The bot's startup sweep only covers the system temp dir;
+            # drop outputs a crashed run left behind in RAM
+            cleanup_stale_temp_files(self._tmp_base)
+        
+        # Probe once for the aria2c external downloader
+        self._has_aria2c = shutil.which('aria2c') is not None
+        
+        # Probe once for a hardware H.264 encoder
+        self._h264_encoder = _detect_h264_encoder()
+        logger.info(f"Using H.264 encoder: {self._h264_encoder}")
+        
+    def _video_encoder_args(self, crf: int, target_bitrate: int) -> list:
+        """Build ffmpeg video encoder arguments for the selected encoder."""
+        if self._h264_encoder == 'h264_nvenc':
+            return [
+                '-c:v', 'h264_nvenc',
+                '-preset', 'p4',
+                '-rc', 'vbr',
+                '-cq', str(crf),
+                '-b:v', f'{target_bitrate}k',
+                '-maxrate', f'{int(1.5 * target_bitrate)}k',
+                '-bufsize', f'{2 * target_bitrate}k',
+            ]
+        
+        if self._h264_encoder in ('h264_qsv', 'h264_videotoolbox'):
+            # No CRF equivalent, so encode to the bitrate cap
+            return [
+                '-c:v', self._h264_encoder,
+                '-b:v', f'{target_bitrate}k',
+                '-maxrate', f'{target_bitrate}k',
+                '-bufsize', f'{2 * target_bitrate}k',
+            ]
+        
+        return [
+            '-c:v', 'libx264',
+            '-preset', 'fast',
+            '-crf', str(crf),
+            '-maxrate', f'{target_bitrate}k',
+            '-bufsize', f'{2 * target_bitrate}k',
+        ]
+        
+    def get_cached_info(self, url: str) -> Optional[Dict[str, Any]]:
+        """Return cached info for a URL if present and not expired."""
+        entry = self._info_cache.get(url)
+        if entry is None:
+            return None
+        
+        expires_at, info = entry
+        if expires_at < time.monotonic():
+            del self._info_cache[url]
+            return None
+        
+        self._info_cache.move_to_end(url)
+        return info
+    
+    def _cache_info(self, url: str, info: Dict[str, Any]):
+        """Store extracted info, evicting the least recently used entry."""
+        self._info_cache[url] = (time.monotonic() + self.info_cache_ttl, info)
+        self._info_cache.move_to_end(url)
+        while len(self._info_cache) > self.info_cache_size:
+            self._info_cache.popitem(last=False)
+        
+    @staticmethod
+    def _create_proc_pool() -> ProcessPoolExecutor:
+        """Create the info extraction pool; workers are spawned rather than
+        forked so they don't inherit the bot's running event loop and threads."""
+        return ProcessPoolExecutor(
+            max_workers=max(2, (os.cpu_count() or 4) // 2),
+            mp_context=multiprocessing.get_context('spawn')
+        )
+
+    async def _run_in_proc_pool(self, func, *args):
+        """Run a function in the worker pool, rebuilding the pool once if a worker died."""
+        loop = asyncio.get_event_loop()
+        pool = self._proc_pool
+        try:
+            return await loop.run_in_executor(pool, func, *args)
+        except BrokenProcessPool:
+            # Concurrent callers may all see the same broken pool; replace it once
+            if self._proc_pool is pool:
+                logger.warning("Info extraction pool broke, restarting workers")
+                self._proc_pool = self._create_proc_pool()
+                pool.shutdown(wait=False)
+            return await loop.run_in_executor(self._proc_pool, func, *args)
+
     async def get_video_info(self, url: str) -> Optional[Dict[str, Any]]:
         """Get video information without downloading."""
+        cached = self.get_cached_info(url)
+        if cached is not None:
+            return cached
+        
         try:
-            def extract_info():
-                with yt_dlp.YoutubeDL(self.ydl_opts_info) as ydl:
-                    info = ydl.extract_info(url, download=False)
-                    # Filter and validate formats
-                    if info and 'formats' in info:
-                        valid_formats = []
-                        for fmt in info['formats']:
-                            if self._is_format_downloadable(fmt):
-                                valid_formats.append(fmt)
-                        info['formats'] = valid_formats
-                    return info
-            
-            # Run in thread pool to avoid blocking
-            loop = asyncio.get_event_loop()
-            info = await loop.run_in_executor(None, extract_info)
+            # Run in a worker process: signature decryption is CPU-bound
+            # Python that would serialize on the GIL in a thread
+            info = await self._run_in_proc_pool(_extract_info_worker, url, self.ydl_opts_info)
             
+            if info:
+                self._cache_info(url, info)
             return info
             
         except Exception as e:
             logger.error(f"Error extracting video info: {str(e)}")
             return None
 
-    def _is_format_downloadable(self, fmt: dict) -> bool:
-        """Check if a format is actually downloadable."""
-        # Skip audio-only formats
-        if fmt.get('vcodec') == 'none':
-            return False
-        
-        # Skip formats without URL
-        if not fmt.get('url'):
-            return False
-        
-        # Skip formats that are marked as unavailable
-        format_note = fmt.get('format_note', '')
-        if format_note and 'unavailable' in str(format_note).lower():
-            return False
-        
-        # Skip very low quality formats (below 144p)
-        height = fmt.get('height', 0)
-        if height > 0 and height < 144:
-            return False
-        
-        # Skip corrupted or incomplete formats
-        if fmt.get('filesize') == 0:
-            return False
-            
-        return True
-
-    async def download_video(self, url: str, output_dir: str, format_id: str = "best") -> Optional[str]:
-        """Download video with specified format."""
+    async def download_video(self, url: str, output_dir: str, format_id: str = "best",
+                             info_dict: Optional[Dict[str, Any]] = None) -> Optional[str]:
+        """Download video with specified format, reusing extracted info when available."""
+        if info_dict is None:
+            info_dict = self.get_cached_info(url)
+        
+        # Reject known-oversize formats before any bytes are fetched
+        if info_dict is not None:
+            fmt = next(
+                (f for f in info_dict.get('formats', []) if f.get('format_id') == format_id),
+                info_dict
+            )
+            expected_size = fmt.get('filesize') or fmt.get('filesize_approx')
+            if expected_size and expected_size > _MAX_DOWNLOAD_BYTES:
+                logger.error(
+                    f"Format {format_id} is too large to download: {format_file_size(expected_size)} "
+                    f"(max: {format_file_size(_MAX_DOWNLOAD_BYTES)})"
+                )
+                return None
+        
         try:
             # Prepare output template
             output_template = os.path.join(output_dir, '%(title)s.%(ext)s')
             
+            # Already-compatible streams only need a remux into mp4; anything
+            # else (or an unknown format) is converted
+            postprocessor = 'FFmpegVideoConvertor'
+            if info_dict is not None and _is_mp4_compatible(info_dict, format_id):
+                postprocessor = 'FFmpegVideoRemuxer'
+            
             # Configure yt-dlp options with better Instagram support
             ydl_opts = {
                 'format': format_id,
@@ -99,17 +399,28 @@ class VideoDownloader:
                 'ignoreerrors': False,
                 'retries': 3,
                 'fragment_retries': 3,
-                'http_chunk_size': 10485760,  # 10MB chunks
-                'max_filesize': 500 * 1024 * 1024,  # 500MB max
+                'concurrent_fragment_downloads': 5,  # Parallel DASH/HLS fragments
+                'http_chunk_size': 10485760,  # 10MB chunks (larger gets throttled)
+                'max_filesize': _MAX_DOWNLOAD_BYTES,
                 'postprocessors': [{
-                    'key': 'FFmpegVideoConvertor',
+                    'key': postprocessor,
                     'preferedformat': 'mp4',
                 }],
             }
             
-            def download():
-                with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                    info = ydl.extract_info(url, download=True)
+            # Multi-connection downloads when aria2c is installed
+            if self._has_aria2c:
+                ydl_opts['external_downloader'] = {'default': 'aria2c'}
+                ydl_opts['external_downloader_args'] = {'aria2c': ['-x', '16', '-s', '16', '-k', '1M']}
+            
+            def download(reused_info: Optional[Dict[str, Any]]):
+                # Only the format, output dir and postprocessor vary between download option sets
+                with self._ydl_pool.acquire(('download', output_dir, format_id, postprocessor), ydl_opts) as ydl:
+                    if reused_info is not None:
+                        # Skip a second extraction; copy since processing mutates the dict
+                        info = ydl.process_ie_result(copy.deepcopy(reused_info), download=True)
+                    else:
+                        info = ydl.extract_info(url, download=True)
                     
                     # Get the actual filename
                     if info and isinstance(info, dict) and 'entries' in info and info['entries']:
@@ -123,18 +434,33 @@ class VideoDownloader:
             
             # Run download in thread pool
             loop = asyncio.get_event_loop()
-            filename = await loop.run_in_executor(None, download)
+            try:
+                filename = await loop.run_in_executor(self._net_pool, download, info_dict)
+            except yt_dlp.utils.DownloadError as e:
+                if info_dict is None:
+                    raise
+                # Media URLs in reused info may have expired; extract once more
+                logger.warning(f"Download with reused info failed, extracting again: {str(e)}")
+                self._info_cache.pop(url, None)
+                filename = await loop.run_in_executor(self._net_pool, download, None)
             
             # Check if file exists and return path
             if os.path.exists(filename):
                 return filename
             else:
-                # Sometimes the extension might be different
-                base_name = os.path.splitext(filename)[0]
-                for ext in ['.mp4', '.mkv', '.webm', '.avi', '.mov']:
-                    potential_file = base_name + ext
-                    if os.path.exists(potential_file):
-                        return potential_file
+                # Sometimes the extension might be different, so look for any
+                # finished file with the same base name in one directory scan
+                base_name = os.path.basename(os.path.splitext(filename)[0])
+                candidates = []
+                with os.scandir(os.path.dirname(filename) or '.') as entries:
+                    for entry in entries:
+                        if (os.path.splitext(entry.name)[0] == base_name
+                                and not entry.name.endswith(_PARTIAL_SUFFIXES)
+                                and entry.is_file()):
+                            candidates.append(entry.path)
+                
+                if candidates:
+                    return next((c for c in candidates if c.endswith('.mp4')), candidates[0])
                 
                 logger.error(f"Downloaded file not found: {filename}")
                 return None
@@ -143,178 +469,266 @@ class VideoDownloader:
             logger.error(f"Error downloading video: {str(e)}")
             return None
 
-    async def compress_video(self, input_path: str, max_size_bytes: int) -> Optional[str]:
-        """Compress video to fit within size limit using ffmpeg."""
+    async def _run_command(self, cmd: list) -> tuple[int, bytes, bytes]:
+        """Run an external command without blocking the event loop."""
+        process = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
         try:
-            if not os.path.exists(input_path):
-                logger.error(f"Input file does not exist: {input_path}")
-                return None
+            stdout, stderr = await process.communicate()
+        except asyncio.CancelledError:
+            # Don't leave the child running if the caller is cancelled
+            process.kill()
+            raise
+        return process.returncode, stdout, stderr
 
-            # Get video duration
-            duration = await self._get_video_duration(input_path)
-            if not duration:
-                logger.error("Could not get video duration")
-                return None
+    async def _run_encode(self, cmd: list) -> tuple[int, bytes, bytes]:
+        """Run an ffmpeg encode once a slot in the shared encode limit is free."""
+        async with self._ffmpeg_sem:
+            return await self._run_command(cmd)
 
-            # Calculate target bitrate (80% of max to leave some headroom)
-            target_bitrate = int((max_size_bytes * 0.8 * 8) / duration / 1000)  # kbps
-            
-            # Minimum bitrate threshold
-            if target_bitrate < 100:
-                logger.error(f"Target bitrate too low: {target_bitrate}kbps")
+    async def compress_video(self, input_path: str, max_size_bytes: int,
+                             duration: Optional[float] = None,
+                             height: Optional[int] = None) -> Optional[str]:
+        """Compress video to fit within size limit using ffmpeg.
+        
+        duration and height can be passed from yt-dlp's info to skip ffprobe.
+        """
+        # Output path
+        with tempfile.NamedTemporaryFile(prefix=TEMP_PREFIX, suffix='.mp4',
+                                         dir=self._tmp_base, delete=False) as output_file:
+            output_path = output_file.name
+        
+        result = await self._compress_into(input_path, output_path, max_size_bytes, duration, height)
+        
+        # Don't leave a failed or partial output behind
+        if result is None and os.path.exists(output_path):
+            os.remove(output_path)
+        return result
+
+    async def _compress_into(self, input_path: str, output_path: str, max_size_bytes: int,
+                             duration: Optional[float], height: Optional[int]) -> Optional[str]:
+        """Compress input_path into output_path, returning output_path if it fits."""
+        segments_dir = None
+        try:
+            if not os.path.exists(input_path):
+                logger.error(f"Input file does not exist: {input_path}")
                 return None
 
-            # Output path
-            output_path = input_path.rsplit('.', 1)[0] + '_compressed.mp4'
-            
-            # FFmpeg command for compression
-            cmd = [
-                'ffmpeg',
-                '-i', input_path,
-                '-c:v', 'libx264',
-                '-b:v', f'{target_bitrate}k',
-                '-c:a', 'aac',
-                '-b:a', '128k',
-                '-preset', 'fast',
-                '-movflags', '+faststart',
-                '-y',  # Overwrite output file
-                output_path
-            ]
-            
-            def run_ffmpeg():
-                process = subprocess.run(
-                    cmd,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    text=True
-                )
-                return process
+            # Only probe when yt-dlp didn't provide duration/height
+            if not duration or not height:
+                probe = await self._probe_video(input_path)
+                if not probe or not probe.get('duration'):
+                    logger.error("Could not get video duration")
+                    return None
+            else:
+                probe = {'duration': float(duration), 'height': height}
+            duration = probe['duration']
             
-            # Run FFmpeg in thread pool
-            loop = asyncio.get_event_loop()
-            process = await loop.run_in_executor(None, run_ffmpeg)
+            # Long software encodes are split once and encoded in parallel
+            segments = None
+            if (self._h264_encoder == 'libx264'
+                    and duration > _SEGMENT_MIN_DURATION
+                    and (os.cpu_count() or 1) > 2):
+                # Segments hold a full copy of the video, so they stay on disk
+                segments_dir = tempfile.mkdtemp(prefix='segments_', dir=os.path.dirname(input_path))
+                segments = await self._split_segments(input_path, segments_dir)
             
-            if process.returncode == 0 and os.path.exists(output_path):
-                # Check if compressed file is smaller
+            # Only move to the next attempt when the encode still doesn't fit
+            for min_crf, size_share, audio_kbps in _COMPRESSION_ATTEMPTS:
+                # Cap the video bitrate to the share of the size limit left
+                # after the audio track (kbps)
+                target_bitrate = int((max_size_bytes * size_share * 8) / duration / 1000) - audio_kbps
+                audio_bitrate = f'{audio_kbps}k'
+                
+                # Skip the encode when the audio alone leaves no room for video
+                if target_bitrate < 50:
+                    logger.warning(f"Video bitrate too low with {audio_bitrate} audio: {target_bitrate}kbps")
+                    continue
+                
+                # Resolution and CRF follow from the bitrate budget
+                target_height, crf = _select_params(probe.get('height'), target_bitrate)
+                crf = max(crf, min_crf)
+                video_filter = f'scale=-2:{target_height}' if target_height else _EVEN_DIMENSIONS_FILTER
+                
+                video_args = self._video_encoder_args(crf, target_bitrate)
+                
+                if segments:
+                    returncode, stderr = await self._encode_segments(
+                        segments, input_path, output_path, video_args, video_filter, audio_bitrate
+                    )
+                else:
+                    # FFmpeg command for CRF encoding with a VBV bitrate cap
+                    cmd = [
+                        *_FFMPEG_CMD,
+                        '-threads', str(self._threads_per_job),
+                        '-i', input_path,
+                        *video_args,
+                        '-threads', str(self._threads_per_job),
+                        '-c:a', 'aac',
+                        '-b:a', audio_bitrate,
+                        '-movflags', '+faststart',
+                        '-vf', video_filter,
+                        '-y',  # Overwrite output file
+                        output_path
+                    ]
+                    
+                    # Run FFmpeg as an asyncio subprocess
+                    returncode, _, stderr = await self._run_encode(cmd)
+                
+                if returncode != 0 or not os.path.exists(output_path):
+                    logger.error(f"FFmpeg compression failed: {_stderr_tail(stderr)}")
+                    return None
+                
+                # Check if compressed file fits
                 compressed_size = os.path.getsize(output_path)
                 if compressed_size <= max_size_bytes:
-                    logger.info(f"Video compressed successfully: {format_file_size(compressed_size)}")
+                    logger.info(f"Video compressed successfully (CRF {crf}, {target_bitrate}kbps): {format_file_size(compressed_size)}")
                     return output_path
-                else:
-                    logger.warning(f"Compressed file still too large: {format_file_size(compressed_size)}")
-                    # Try with lower bitrate
-                    os.remove(output_path)
-                    return await self._compress_aggressively(input_path, max_size_bytes, duration)
-            else:
-                logger.error(f"FFmpeg compression failed: {process.stderr}")
-                return None
+                
+                logger.warning(f"Compressed file still too large at CRF {crf}: {format_file_size(compressed_size)}")
+            
+            logger.error("Could not compress video below the size limit")
+            return None
                 
         except Exception as e:
             logger.error(f"Error compressing video: {str(e)}")
             return None
+        
+        finally:
+            if segments_dir:
+                shutil.rmtree(segments_dir, ignore_errors=True)
 
-    async def _compress_aggressively(self, input_path: str, max_size_bytes: int, duration: float) -> Optional[str]:
-        """More aggressive compression for very large files."""
-        try:
-            # Even lower bitrate (60% of max)
-            target_bitrate = int((max_size_bytes * 0.6 * 8) / duration / 1000)
-            
-            if target_bitrate < 50:
-                logger.error("Cannot compress further - file too large")
-                return None
+    async def _split_segments(self, input_path: str, segments_dir: str) -> Optional[list]:
+        """Split the video stream into keyframe-aligned segments without re-encoding."""
+        pattern = os.path.join(segments_dir, 'seg_%03d.mkv')
+        cmd = [
+            *_FFMPEG_CMD,
+            '-i', input_path,
+            '-map', '0:v:0',
+            '-c', 'copy',
+            '-f', 'segment',
+            '-segment_time', str(_SEGMENT_DURATION),
+            '-reset_timestamps', '1',
+            '-y',
+            pattern
+        ]
+        
+        returncode, _, stderr = await self._run_command(cmd)
+        if returncode != 0:
+            logger.warning(f"Segment split failed, encoding in one pass: {_stderr_tail(stderr)}")
+            return None
+        
+        segments = sorted(
+            os.path.join(segments_dir, name)
+            for name in os.listdir(segments_dir)
+            if name.startswith('seg_') and name.endswith('.mkv')
+        )
+        # Splitting only pays off with more than one segment
+        return segments if len(segments) > 1 else None
 
-            output_path = input_path.rsplit('.', 1)[0] + '_compressed_aggressive.mp4'
-            
+    async def _encode_segments(self, segments: list, input_path: str, output_path: str,
+                               video_args: list, video_filter: str, audio_bitrate: str) -> tuple[int, bytes]:
+        """Encode video segments in parallel, then stitch them with the source audio."""
+        # Per-video cap on top of the shared encode limit
+        job_sem = asyncio.Semaphore(self.max_segment_encodes)
+        
+        async def encode(segment: str) -> tuple[int, bytes]:
+            segment_output = segment[:-len('.mkv')] + '.mp4'
             cmd = [
-                'ffmpeg',
-                '-i', input_path,
-                '-c:v', 'libx264',
-                '-b:v', f'{target_bitrate}k',
-                '-c:a', 'aac',
-                '-b:a', '64k',  # Lower audio bitrate
-                '-preset', 'ultrafast',
-                '-crf', '28',  # Higher compression
-                '-movflags', '+faststart',
-                '-vf', 'scale=trunc(iw/2)*2:trunc(ih/2)*2',  # Ensure even dimensions
+                *_FFMPEG_CMD,
+                '-threads', str(self._threads_per_job),
+                '-i', segment,
+                *video_args,
+                '-threads', str(self._threads_per_job),
+                '-an',
+                '-vf', video_filter,
                 '-y',
-                output_path
+                segment_output
             ]
-            
-            def run_ffmpeg():
-                process = subprocess.run(
-                    cmd,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    text=True
-                )
-                return process
-            
-            loop = asyncio.get_event_loop()
-            process = await loop.run_in_executor(None, run_ffmpeg)
-            
-            if process.returncode == 0 and os.path.exists(output_path):
-                compressed_size = os.path.getsize(output_path)
-                if compressed_size <= max_size_bytes:
-                    logger.info(f"Video aggressively compressed: {format_file_size(compressed_size)}")
-                    return output_path
-                else:
-                    logger.error(f"Even aggressive compression failed: {format_file_size(compressed_size)}")
-                    os.remove(output_path)
-                    return None
-            else:
-                logger.error(f"Aggressive FFmpeg compression failed: {process.stderr}")
-                return None
-                
-        except Exception as e:
-            logger.error(f"Error in aggressive compression: {str(e)}")
-            return None
+            async with job_sem:
+                returncode, _, stderr = await self._run_encode(cmd)
+            return returncode, stderr
+        
+        results = await asyncio.gather(*(encode(segment) for segment in segments))
+        for returncode, stderr in results:
+            if returncode != 0:
+                return returncode, stderr
+        
+        # Concat demuxer list of encoded segments
+        list_path = os.path.join(os.path.dirname(segments[0]), 'segments.txt')
+        with open(list_path, 'w') as f:
+            for segment in segments:
+                segment_output = segment[:-len('.mkv')] + '.mp4'
+                escaped = segment_output.replace("'", "'\\''")
+                f.write(f"file '{escaped}'\n")
+        
+        # Stitch the video and encode audio once from the original input
+        cmd = [
+            *_FFMPEG_CMD,
+            '-f', 'concat',
+            '-safe', '0',
+            '-i', list_path,
+            '-i', input_path,
+            '-map', '0:v:0',
+            '-map', '1:a:0?',
+            '-c:v', 'copy',
+            '-c:a', 'aac',
+            '-b:a', audio_bitrate,
+            '-movflags', '+faststart',
+            '-y',
+            output_path
+        ]
+        returncode, _, stderr = await self._run_command(cmd)
+        return returncode, stderr
 
-    async def _get_video_duration(self, video_path: str) -> Optional[float]:
-        """Get video duration using ffprobe."""
+    async def _probe_video(self, video_path: str) -> Optional[Dict[str, Any]]:
+        """Get video duration and height using ffprobe."""
         try:
+            # Only ask for the fields we read to keep the JSON small
             cmd = [
                 'ffprobe',
                 '-v', 'quiet',
                 '-print_format', 'json',
-                '-show_format',
-                '-show_streams',
+                '-show_entries', 'format=duration:stream=codec_type,height',
                 video_path
             ]
             
-            def run_ffprobe():
-                process = subprocess.run(
-                    cmd,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    text=True
-                )
-                return process
-            
-            loop = asyncio.get_event_loop()
-            process = await loop.run_in_executor(None, run_ffprobe)
+            returncode, stdout, stderr = await self._run_command(cmd)
             
-            if process.returncode == 0:
-                import json
-                data = json.loads(process.stdout)
-                duration = float(data['format']['duration'])
-                return duration
+            if returncode == 0:
+                data = json.loads(stdout)
+                video_stream = next(
+                    (st for st in data.get('streams', []) if st.get('codec_type') == 'video'),
+                    {}
+                )
+                return {
+                    'duration': float(data['format']['duration']),
+                    'height': video_stream.get('height'),
+                }
             else:
-                logger.error(f"ffprobe failed: {process.stderr}")
+                logger.error(f"ffprobe failed: {_stderr_tail(stderr)}")
                 return None
                 
         except Exception as e:
-            logger.error(f"Error getting video duration: {str(e)}")
+            logger.error(f"Error probing video: {str(e)}")
             return None
 
-    def get_supported_sites(self) -> list:
+    def get_supported_sites(self) -> tuple:
         """Get list of supported sites from yt-dlp."""
+        # The extractor list is fixed for the process, so build it once
+        if VideoDownloader._supported_sites_cache is not None:
+            return VideoDownloader._supported_sites_cache
+        
         try:
             extractors = yt_dlp.list_extractors()
-            sites = []
-            for extractor in extractors:
-                if hasattr(extractor, 'IE_NAME'):
-                    sites.append(extractor.IE_NAME)
-            return sorted(sites)
+            sites = tuple(sorted(
+                extractor.IE_NAME for extractor in extractors if hasattr(extractor, 'IE_NAME')
+            ))
+            VideoDownloader._supported_sites_cache = sites
+            return sites
         except Exception as e:
             logger.error(f"Error getting supported sites: {str(e)}")
-            return []
+            return ()